@@ -3,15 +3,12 @@ Nivalis Production Entry Point
 Production-ready Flask application with proper configuration
 """
 import os
-import logging
 from flask import Flask
 from werkzeug.middleware.proxy_fix import ProxyFix
+from log_config import configure_logging
 
 # Configure logging for production
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s: %(message)s'
-)
+configure_logging()
 
 # Import the main application
 from web import app
@@ -10,6 +10,8 @@ from datetime import datetime, timedelta
 from functools import wraps
 from flask import request, session, jsonify, redirect, url_for
 from replit import db
+from profiling import traced
+from migrate import mirror_write
 import logging
 
 logger = logging.getLogger(__name__)
@@ -70,6 +72,7 @@ class UserManager:
     """Manages user data and operations"""
     
     @staticmethod
+    @traced('user_store')
     def create_user(telegram_id, email=None, name=None):
         """Create new user account"""
         user_data = {
@@ -88,6 +91,7 @@ class UserManager:
         # Store user data
         user_key = f"user:{telegram_id}"
         db[user_key] = user_data
+        mirror_write('users', telegram_id, user_data)
         
         # Add to user index
         user_index = db.get("user_index", [])
@@ -99,12 +103,36 @@ class UserManager:
         return user_data
     
     @staticmethod
+    @traced('user_store')
     def get_user(telegram_id):
         """Get user by Telegram ID"""
         user_key = f"user:{telegram_id}"
-        return db.get(user_key)
+        user = db.get(user_key)
+        if user and user.get('history_archived'):
+            from retention import restore_user
+            restore_user(telegram_id)
+            user = db.get(user_key)
+        return user
     
     @staticmethod
+    def iter_users(page_size=100, after=None):
+        """Yield pages of user records in Telegram ID order, starting after a cursor"""
+        # Only the key listing is held in memory; records are fetched a page at a time
+        user_ids = sorted(key[len("user:"):] for key in db.prefix("user:"))
+        if after is not None:
+            user_ids = [user_id for user_id in user_ids if user_id > str(after)]
+        
+        for start in range(0, len(user_ids), page_size):
+            page = []
+            for user_id in user_ids[start:start + page_size]:
+                user = db.get(f"user:{user_id}")
+                if user:
+                    page.append(user)
+            if page:
+                yield page
+    
+    @staticmethod
+    @traced('user_store')
     def update_user(telegram_id, updates):
         """Update user data"""
         user_key = f"user:{telegram_id}"
@@ -113,6 +141,7 @@ class UserManager:
             user_data.update(updates)
             user_data['updated_at'] = datetime.utcnow().isoformat()
             db[user_key] = user_data
+            mirror_write('users', telegram_id, user_data)
             return user_data
         return None
     
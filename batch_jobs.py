@@ -0,0 +1,279 @@
+"""
+Offline Batch Generation for Nivalis
+Builds per-user LLM request files, runs them in bulk away from the webhook
+workers and ingests the results back into user records idempotently
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = os.environ.get('BATCH_DIR', 'batch_jobs')
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 16))
+BATCH_MODEL = os.environ.get('BATCH_MODEL', 'gpt-4o')
+BATCH_POLL_SECONDS = 30
+
+SYSTEM_PROMPT = "You are Nivalis, Antonio's digital clone - a business strategist who helps users transform skills into high-ticket offers."
+
+JOBS = {
+    'plan_30_day': {
+        'field': 'plan_30_day',
+        'max_tokens': 2000,
+        'prompt': (
+            "Using this client profile, write a personalised 30-day action plan to reach their "
+            "income goal. Group it by week, give concrete daily actions that fit their time "
+            "commitment and capital, and address their biggest challenge first.\n\n{profile}"
+        )
+    },
+    'profile_narrative': {
+        'field': 'profile_narrative',
+        'max_tokens': 400,
+        'prompt': (
+            "Summarise this client profile in one paragraph for a strategist: where they are, "
+            "what they want, and what is most likely holding them back.\n\n{profile}"
+        )
+    }
+}
+
+def prompt_version(job_name):
+    """Changes whenever a job's prompt or model changes, forcing regeneration"""
+    job = JOBS[job_name]
+    seed = f"{BATCH_MODEL}|{job['max_tokens']}|{job['prompt']}"
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()[:12]
+
+def profile_input(user):
+    from onboarding import OnboardingFlow
+    return user.get('profile_summary') or OnboardingFlow.generate_profile_summary(user.get('onboarding_data', {}))
+
+def profile_hash(user):
+    """Changes whenever the user's profile input changes, e.g. after redoing onboarding"""
+    canonical = json.dumps(profile_input(user), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:12]
+
+def job_paths(job_name):
+    version = prompt_version(job_name)
+    base = os.path.join(BATCH_DIR, f"{job_name}-{version}")
+    return f"{base}.requests.jsonl", f"{base}.results.jsonl"
+
+def is_eligible(user, job_name):
+    if not user.get('onboarding_completed'):
+        return False
+    existing = user.get(JOBS[job_name]['field']) or {}
+    return (existing.get('prompt_version') != prompt_version(job_name)
+            or existing.get('profile_hash') != profile_hash(user))
+
+def build_request(user, job_name):
+    """One request line in OpenAI Batch API format"""
+    job = JOBS[job_name]
+    profile = profile_input(user)
+    return {
+        'custom_id': f"{job_name}:{user['telegram_id']}:{prompt_version(job_name)}:{profile_hash(user)}",
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {
+            'model': BATCH_MODEL,
+            'messages': [
+                {'role': 'system', 'content': SYSTEM_PROMPT},
+                {'role': 'user', 'content': job['prompt'].format(profile=json.dumps(profile, ensure_ascii=False))}
+            ],
+            'max_tokens': job['max_tokens'],
+            'temperature': 0.7
+        }
+    }
+
+def build_requests(job_name, limit=None):
+    """Stream eligible users into the job's request file; returns the request count"""
+    from auth import UserManager
+    requests_path, _ = job_paths(job_name)
+    os.makedirs(BATCH_DIR, exist_ok=True)
+
+    count = 0
+    with open(requests_path, 'w', encoding='utf-8') as f:
+        for page in UserManager.iter_users():
+            for user in page:
+                if is_eligible(user, job_name):
+                    f.write(json.dumps(build_request(user, job_name), ensure_ascii=False) + '\n')
+                    count += 1
+                    if limit and count >= limit:
+                        return count
+    return count
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def result_line(custom_id, content=None, error=None):
+    """Result line in the same shape the Batch API returns"""
+    if error is not None:
+        return {'custom_id': custom_id, 'response': None, 'error': {'message': str(error)}}
+    return {
+        'custom_id': custom_id,
+        'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}},
+        'error': None
+    }
+
+class ConcurrentBackend:
+    """Calls chat completions directly with bounded concurrency"""
+
+    def __init__(self, concurrency=BATCH_CONCURRENCY):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=5)
+        self.concurrency = concurrency
+
+    def complete(self, request):
+        try:
+            response = self.client.chat.completions.create(**request['body'])
+            return result_line(request['custom_id'], response.choices[0].message.content)
+        except Exception as e:
+            return result_line(request['custom_id'], error=e)
+
+    def run(self, requests_path, results_path):
+        # Requests already answered in an earlier, interrupted run are skipped
+        done = {line['custom_id'] for line in read_jsonl(results_path) if not line.get('error')}
+        pending = [r for r in read_jsonl(requests_path) if r['custom_id'] not in done]
+        window = self.concurrency * 4
+        with open(results_path, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for start in range(0, len(pending), window):
+                for line in pool.map(self.complete, pending[start:start + window]):
+                    out.write(json.dumps(line, ensure_ascii=False) + '\n')
+                out.flush()
+
+class OpenAIBatchBackend:
+    """Submits the request file through the OpenAI Batch API and waits for it"""
+
+    def __init__(self, poll_seconds=BATCH_POLL_SECONDS):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+        self.poll_seconds = poll_seconds
+
+    def run(self, requests_path, results_path):
+        with open(requests_path, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=uploaded.id,
+                                           endpoint='/v1/chat/completions',
+                                           completion_window='24h')
+        logger.info(f"Submitted batch {batch.id}")
+
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            time.sleep(self.poll_seconds)
+            batch = self.client.batches.retrieve(batch.id)
+        if batch.status != 'completed':
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        with open(results_path, 'a', encoding='utf-8') as out:
+            for file_id in filter(None, (batch.output_file_id, batch.error_file_id)):
+                text = self.client.files.content(file_id).text
+                out.write(text if text.endswith('\n') else f"{text}\n")
+
+class LocalBackend:
+    """Deterministic stand-in for development and tests; no network calls"""
+
+    def run(self, requests_path, results_path):
+        with open(results_path, 'a', encoding='utf-8') as out:
+            for request in read_jsonl(requests_path):
+                prompt = request['body']['messages'][-1]['content']
+                content = f"[local] {hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+                out.write(json.dumps(result_line(request['custom_id'], content)) + '\n')
+
+BACKENDS = {
+    'concurrent': ConcurrentBackend,
+    'openai-batch': OpenAIBatchBackend,
+    'local': LocalBackend
+}
+
+def ingest_results(job_name):
+    """Write results into user records; re-running never duplicates or overwrites newer output"""
+    from auth import db
+    from migrate import mirror_write
+    _, results_path = job_paths(job_name)
+    field = JOBS[job_name]['field']
+    stats = {'stored': 0, 'skipped': 0, 'errors': 0}
+
+    for line in read_jsonl(results_path):
+        _, telegram_id, version, input_hash = (line['custom_id'].split(':', 3) + [None])[:4]
+        response = line.get('response') or {}
+        if line.get('error') or response.get('status_code') != 200:
+            stats['errors'] += 1
+            continue
+
+        # Read and written straight to db: get_user would restore archived users and
+        # update_user bumps updated_at, which retention uses to judge idleness
+        user_key = f"user:{telegram_id}"
+        user = db.get(user_key)
+        existing = user.get(field) if user else None
+        # Results built from a profile the user has since changed are stale
+        if not user or (input_hash and input_hash != profile_hash(user)) or (
+                existing and existing.get('prompt_version') == version
+                and existing.get('profile_hash') == input_hash):
+            stats['skipped'] += 1
+            continue
+
+        user[field] = {
+            'content': response['body']['choices'][0]['message']['content'],
+            'prompt_version': version,
+            'profile_hash': input_hash,
+            'generated_at': datetime.utcnow().isoformat()
+        }
+        db[user_key] = user
+        mirror_write('users', telegram_id, user)
+        stats['stored'] += 1
+    return stats
+
+def run_job(job_name, backend_name='concurrent', limit=None):
+    """Build, execute and ingest one job, reporting throughput"""
+    started = time.monotonic()
+    requests_path, results_path = job_paths(job_name)
+
+    built = build_requests(job_name, limit)
+    logger.info(f"Built {built} {job_name} requests in {requests_path}")
+    if built:
+        generate_started = time.monotonic()
+        BACKENDS[backend_name]().run(requests_path, results_path)
+        generate_seconds = time.monotonic() - generate_started
+    else:
+        generate_seconds = 0
+
+    stats = ingest_results(job_name)
+    elapsed = time.monotonic() - started
+    stats.update({
+        'job': job_name,
+        'backend': backend_name,
+        'requests': built,
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(built / generate_seconds, 2) if generate_seconds else 0
+    })
+    logger.info(f"Batch job finished: {stats}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run offline LLM generation jobs for Nivalis users')
+    parser.add_argument('command', choices=['run', 'build', 'ingest'])
+    parser.add_argument('job', choices=sorted(JOBS))
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='concurrent')
+    parser.add_argument('--limit', type=int, help='cap the number of users in this run')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        result = {'requests': build_requests(args.job, args.limit), 'file': job_paths(args.job)[0]}
+    elif args.command == 'ingest':
+        result = ingest_results(args.job)
+    else:
+        result = run_job(args.job, args.backend, args.limit)
+    print(json.dumps(result))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
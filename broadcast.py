@@ -0,0 +1,212 @@
+"""
+Subscriber Broadcast Engine for Nivalis
+Streams recipients page by page, sends with bounded concurrency under the
+Telegram rate limit and checkpoints progress so broadcasts can resume
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Telegram allows roughly 30 messages per second across all chats
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 30))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+BROADCAST_PAGE_SIZE = 100
+CHECKPOINT_DIR = os.environ.get('BROADCAST_CHECKPOINT_DIR', 'broadcasts')
+MAX_RETRIES = 3
+
+PAID_TIERS = ['basic', 'mvp_lifetime', 'premium']
+
+class RateLimiter:
+    """Token bucket shared by all sender threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Push every sender back after a 429 from Telegram"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+class Checkpoint:
+    """Progress of one broadcast, persisted as a JSON file after every recipient"""
+
+    def __init__(self, broadcast_id, directory=CHECKPOINT_DIR):
+        self.path = os.path.join(directory, f"{broadcast_id}.json")
+        self.state = {
+            'broadcast_id': broadcast_id,
+            'text': None,
+            'cursor': None,
+            # chat_ids already handled on the page after cursor
+            'page_done': [],
+            'delivered': 0,
+            'failed': 0,
+            'blocked': 0,
+            'skipped': 0,
+            'started_at': datetime.utcnow().isoformat(),
+            'completed_at': None
+        }
+        try:
+            with open(self.path, 'r') as f:
+                self.state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def counts(self):
+        return {key: self.state[key] for key in ('delivered', 'failed', 'blocked', 'skipped')}
+
+class Broadcaster:
+    """Sends one message to every eligible user, resuming from a checkpoint"""
+
+    def __init__(self, bot_token=TELEGRAM_BOT_TOKEN, rate=BROADCAST_RATE,
+                 concurrency=BROADCAST_CONCURRENCY, page_size=BROADCAST_PAGE_SIZE,
+                 api_url=TELEGRAM_API_URL, subscribers_only=True):
+        self.url = f"{api_url}/bot{bot_token}/sendMessage"
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.subscribers_only = subscribers_only
+        self.local = threading.local()
+
+    def http(self):
+        """One pooled HTTP session per sender thread"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def deliver(self, chat_id, text):
+        """Send one message, returning 'delivered', 'blocked' or 'failed'"""
+        payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
+        for attempt in range(MAX_RETRIES):
+            self.limiter.wait()
+            try:
+                response = self.http().post(self.url, json=payload, timeout=10)
+            except Exception as e:
+                logger.warning(f"Broadcast send error for {chat_id}: {e}")
+                continue
+
+            if response.status_code == 200:
+                return 'delivered'
+            if response.status_code == 403:
+                return 'blocked'
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+                except ValueError:
+                    retry_after = 1
+                self.limiter.pause(retry_after)
+                continue
+            if response.status_code < 500:
+                return 'failed'
+        return 'failed'
+
+    def is_recipient(self, user):
+        if not self.subscribers_only:
+            return True
+        return user.get('subscription_status', 'none') in PAID_TIERS
+
+    def run(self, broadcast_id, text=None):
+        """Send (or resume) a broadcast and return its delivery counts"""
+        from auth import UserManager
+        checkpoint = Checkpoint(broadcast_id)
+        if checkpoint.state['completed_at']:
+            logger.info(f"Broadcast {broadcast_id} already completed")
+            return checkpoint.counts()
+
+        if checkpoint.state['text'] is None:
+            if not text:
+                raise ValueError(f"No message text for new broadcast {broadcast_id}")
+            checkpoint.state['text'] = text
+            checkpoint.save()
+        text = checkpoint.state['text']
+
+        if checkpoint.state['cursor']:
+            logger.info(f"Resuming broadcast {broadcast_id} after user {checkpoint.state['cursor']}")
+
+        started = time.monotonic()
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for page in UserManager.iter_users(self.page_size, after=checkpoint.state['cursor']):
+                done = set(checkpoint.state['page_done'])
+                recipients = [user for user in page if self.is_recipient(user)]
+
+                # Recipients finished before an interruption are not messaged twice
+                chat_ids = [user['telegram_id'] for user in recipients if user['telegram_id'] not in done]
+                futures = {pool.submit(self.deliver, chat_id, text): chat_id for chat_id in chat_ids}
+                for future in as_completed(futures):
+                    checkpoint.state[future.result()] += 1
+                    checkpoint.state['page_done'].append(futures[future])
+                    checkpoint.save()
+                sent += len(chat_ids)
+
+                checkpoint.state['skipped'] += len(page) - len(recipients)
+                checkpoint.state['cursor'] = page[-1]['telegram_id']
+                checkpoint.state['page_done'] = []
+                checkpoint.save()
+
+        elapsed = time.monotonic() - started
+        checkpoint.state['completed_at'] = datetime.utcnow().isoformat()
+        checkpoint.save()
+
+        counts = checkpoint.counts()
+        rate = sent / elapsed if elapsed else 0
+        logger.info(f"Broadcast {broadcast_id} finished: {counts} ({rate:.1f} msg/s)")
+        return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Broadcast a message to Nivalis users')
+    parser.add_argument('broadcast_id', help='stable id used to checkpoint and resume')
+    parser.add_argument('--message-file', help='file containing the HTML message text')
+    parser.add_argument('--rate', type=float, default=BROADCAST_RATE, help='messages per second')
+    parser.add_argument('--concurrency', type=int, default=BROADCAST_CONCURRENCY)
+    parser.add_argument('--all-users', action='store_true', help='include non-subscribers')
+    args = parser.parse_args(argv)
+
+    if not TELEGRAM_BOT_TOKEN:
+        parser.error('TELEGRAM_BOT_TOKEN is not set')
+
+    text = None
+    if args.message_file:
+        with open(args.message_file, 'r') as f:
+            text = f.read()
+
+    broadcaster = Broadcaster(rate=args.rate, concurrency=args.concurrency,
+                              subscribers_only=not args.all_users)
+    counts = broadcaster.run(args.broadcast_id, text)
+    print(json.dumps(counts))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -18,10 +18,21 @@ max_requests_jitter = 50
 
 # Logging
 loglevel = "info"
-accesslog = "-"
+accesslog = os.environ.get("ACCESS_LOG", "-") or None
 errorlog = "-"
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 
+def post_worker_init(worker):
+    """Queue gunicorn's logs and install the profiler signal in each worker"""
+    import logging
+    from log_config import queue_logger
+    queue_logger(logging.getLogger("gunicorn.access"))
+    queue_logger(logging.getLogger("gunicorn.error"))
+
+    # kill -USR2 <worker pid> toggles the sampling profiler in that worker
+    from profiling import install_signal_handler
+    install_signal_handler()
+
 # Process naming
 proc_name = "nivalis"
 
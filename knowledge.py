@@ -0,0 +1,250 @@
+"""
+Methodology Knowledge Index for Nivalis
+Offline builder and memory-mapped vector search used to ground AI
+responses in the Nivalis methodology documents
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import uuid
+import logging
+from datetime import datetime
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_INDEX_DIR = os.environ.get('KNOWLEDGE_INDEX_DIR', 'knowledge_index')
+VECTORS_FILE = 'vectors.npy'
+METADATA_FILE = 'chunks.json'
+# Names the live build directory inside KNOWLEDGE_INDEX_DIR; replaced atomically
+VERSION_FILE = 'CURRENT'
+STALE_BUILD_SECONDS = 3600
+DOCUMENT_EXTENSIONS = ('.md', '.txt')
+
+CHUNK_WORDS = 180
+CHUNK_OVERLAP = 30
+EMBED_BATCH_SIZE = 64
+CONTEXT_TOKEN_BUDGET = 1200
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9£$%']+")
+
+class HashingEmbedder:
+    """Deterministic local embedder: hashed unigrams and bigrams, L2-normalised"""
+
+    name = 'hashing'
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = TOKEN_PATTERN.findall(text.lower())
+            for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+                digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign
+        return normalize(vectors)
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI API"""
+
+    name = 'openai'
+
+    def __init__(self, model='text-embedding-3-small'):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+        self.model = model
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(model=self.model, input=list(texts))
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        return normalize(vectors)
+
+EMBEDDERS = {
+    'hashing': HashingEmbedder,
+    'openai': OpenAIEmbedder
+}
+
+def get_embedder(name=None):
+    """Embedder by name; defaults to OpenAI when a key is configured"""
+    if name is None:
+        name = os.environ.get('KNOWLEDGE_EMBEDDER') or ('openai' if os.environ.get('OPENAI_API_KEY') else 'hashing')
+    return EMBEDDERS[name]()
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def chunk_text(text, max_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping word windows"""
+    words = text.split()
+    chunks = []
+    step = max(max_words - overlap, 1)
+    for start in range(0, len(words), step):
+        chunks.append(' '.join(words[start:start + max_words]))
+        if start + max_words >= len(words):
+            break
+    return chunks
+
+def current_version(index_dir=KNOWLEDGE_INDEX_DIR):
+    """Live build name, '' for an unversioned index, None when nothing is built"""
+    try:
+        with open(os.path.join(index_dir, VERSION_FILE), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return '' if os.path.exists(os.path.join(index_dir, METADATA_FILE)) else None
+
+def is_stale(path, max_age=STALE_BUILD_SECONDS):
+    try:
+        return time.time() - os.path.getmtime(path) > max_age
+    except OSError:
+        return False
+
+def publish_version(index_dir, version):
+    """Point VERSION_FILE at a finished build and drop all but the previous one"""
+    previous = current_version(index_dir)
+    tmp_path = os.path.join(index_dir, f"{VERSION_FILE}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(index_dir, VERSION_FILE))
+
+    # Workers still on the previous build keep reading it until they notice the switch
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if name.startswith('v') and name not in (version, previous):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.startswith('.v') and name.endswith('.tmp') and is_stale(path):
+            # Left behind by a build that was killed; recent ones may still be running
+            shutil.rmtree(path, ignore_errors=True)
+
+def build_index(source_dir, index_dir=KNOWLEDGE_INDEX_DIR, embedder=None):
+    """Chunk every document under source_dir into a new build, then switch to it"""
+    embedder = embedder or get_embedder()
+
+    chunks = []
+    for dirpath, _, filenames in os.walk(source_dir):
+        for name in sorted(filenames):
+            if not name.endswith(DOCUMENT_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            source = os.path.relpath(path, source_dir)
+            chunks.extend({'source': source, 'text': chunk} for chunk in chunk_text(text))
+
+    if not chunks:
+        raise ValueError(f"No {'/'.join(DOCUMENT_EXTENSIONS)} documents found in {source_dir}")
+
+    batches = [
+        embedder.embed([chunk['text'] for chunk in chunks[start:start + EMBED_BATCH_SIZE]])
+        for start in range(0, len(chunks), EMBED_BATCH_SIZE)
+    ]
+
+    # Written beside the live build so readers never see a half-written vectors.npy
+    version = f"v{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    build_dir = os.path.join(index_dir, f".{version}.tmp")
+    os.makedirs(build_dir)
+    try:
+        write_build(build_dir, chunks, batches, embedder.name)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    os.replace(build_dir, os.path.join(index_dir, version))
+    publish_version(index_dir, version)
+
+    logger.info(f"Built knowledge index {version} with {len(chunks)} chunks from {source_dir}")
+    return len(chunks)
+
+def write_build(build_dir, chunks, batches, embedder_name):
+    dim = batches[0].shape[1]
+    vectors = np.lib.format.open_memmap(os.path.join(build_dir, VECTORS_FILE), mode='w+',
+                                        dtype=np.float32, shape=(len(chunks), dim))
+    row = 0
+    for batch in batches:
+        vectors[row:row + len(batch)] = batch
+        row += len(batch)
+    vectors.flush()
+    del vectors
+
+    with open(os.path.join(build_dir, METADATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'embedder': embedder_name, 'dim': dim, 'chunks': chunks}, f, ensure_ascii=False)
+
+class KnowledgeIndex:
+    """Read-only, memory-mapped index; workers share the pages through the OS cache"""
+
+    def __init__(self, index_dir=KNOWLEDGE_INDEX_DIR, embedder=None, version=''):
+        self.version = version
+        with open(os.path.join(index_dir, METADATA_FILE), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        self.chunks = metadata['chunks']
+        self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode='r')
+        if embedder is None:
+            if metadata['embedder'] == HashingEmbedder.name:
+                embedder = HashingEmbedder(metadata['dim'])
+            else:
+                embedder = get_embedder(metadata['embedder'])
+        self.embedder = embedder
+
+    def search(self, query, k=5):
+        """Top-k chunks by cosine similarity, best first"""
+        if not len(self.chunks):
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        scores = self.vectors @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(self.chunks[i], score=float(scores[i])) for i in top]
+
+    def build_context(self, query, token_budget=CONTEXT_TOKEN_BUDGET, k=8):
+        """Retrieved chunks formatted for the system prompt, within a token budget"""
+        sections = []
+        used = 0
+        for hit in self.search(query, k):
+            cost = estimate_tokens(hit['text'])
+            if used + cost > token_budget:
+                break
+            sections.append(f"[{hit['source']}]\n{hit['text']}")
+            used += cost
+        return '\n\n'.join(sections)
+
+_index = None
+
+def get_index():
+    """Process-wide index, reopened when a rebuild publishes a new version"""
+    global _index
+    version = current_version(KNOWLEDGE_INDEX_DIR)
+    if version is None:
+        return None
+    if _index is None or _index.version != version:
+        _index = KnowledgeIndex(os.path.join(KNOWLEDGE_INDEX_DIR, version), version=version)
+        logger.info(f"Loaded knowledge index {version or KNOWLEDGE_INDEX_DIR}")
+    return _index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the Nivalis methodology knowledge index')
+    parser.add_argument('source_dir', help='directory of .md/.txt methodology documents')
+    parser.add_argument('--index-dir', default=KNOWLEDGE_INDEX_DIR)
+    parser.add_argument('--embedder', choices=sorted(EMBEDDERS))
+    args = parser.parse_args(argv)
+
+    count = build_index(args.source_dir, args.index_dir, get_embedder(args.embedder))
+    print(json.dumps({'chunks': count, 'index_dir': args.index_dir,
+                      'version': current_version(args.index_dir)}))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Logging Pipeline for Nivalis
+Queue-based logging: request threads only enqueue records, a background
+listener formats them as JSON lines and writes them out
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import hashlib
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Comma-separated event=rate pairs, e.g. "telegram_message=0.1"
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '')
+# How user message text is logged: hash, truncate or full
+LOG_MESSAGE_BODIES = os.environ.get('LOG_MESSAGE_BODIES', 'hash')
+LOG_TRUNCATE_AT = 40
+
+# Attributes every LogRecord has; anything else came from extra= and is emitted
+RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+listeners = []
+
+def redact_text(text):
+    """Make a user message body safe and cheap to log"""
+    text = text or ''
+    if LOG_MESSAGE_BODIES == 'full':
+        return text
+    if LOG_MESSAGE_BODIES == 'truncate':
+        return text if len(text) <= LOG_TRUNCATE_AT else f"{text[:LOG_TRUNCATE_AT]}…"
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+    return f"<{len(text)} chars sha256:{digest}>"
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; runs on the listener thread"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records tagged with a high-volume event"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+class LazyQueueHandler(QueueHandler):
+    """Enqueue the record untouched so %-formatting happens on the listener"""
+
+    def prepare(self, record):
+        return record
+
+def stop_listeners():
+    for listener in listeners:
+        listener.stop()
+    listeners.clear()
+
+def restart_listeners():
+    """Listener threads do not survive fork; start fresh ones in the child"""
+    for listener in listeners:
+        listener._thread = None
+        listener.start()
+
+def queue_logger(logger, formatter=None):
+    """Move a logger's existing handlers behind a queue and background thread"""
+    handlers = list(logger.handlers)
+    if not handlers or any(isinstance(h, QueueHandler) for h in handlers):
+        return None
+
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+        if formatter is not None:
+            handler.setFormatter(formatter)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    listeners.append(listener)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    return listener
+
+def configure_logging(level=LOG_LEVEL, stream=None):
+    """Install the queued JSON pipeline on the root logger (idempotent)"""
+    root = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler(stream or sys.stderr))
+    root.setLevel(level)
+
+    queue_logger(root, JsonFormatter())
+    rates = parse_sample_rates(LOG_SAMPLE_RATES)
+    if rates:
+        for handler in root.handlers:
+            handler.addFilter(SamplingFilter(rates))
+
+atexit.register(stop_listeners)
+os.register_at_fork(after_in_child=restart_listeners)
+
+class SlowStream:
+    """Sink whose writes block, like stderr behind a busy pipe or log shipper"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def write(self, data):
+        time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+def benchmark(iterations=5000, write_latency=0.0001):
+    """Caller-side cost of one log call: inline stream handler vs queued pipeline"""
+    results = {}
+    inline = logging.getLogger('nivalis.bench.inline')
+    inline.propagate = False
+    inline.addHandler(logging.StreamHandler(SlowStream(write_latency)))
+    inline.handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+
+    queued = logging.getLogger('nivalis.bench.queued')
+    queued.propagate = False
+    queued.addHandler(logging.StreamHandler(SlowStream(write_latency)))
+    listener = queue_logger(queued, JsonFormatter())
+
+    for name, logger in (('inline', inline), ('queued', queued)):
+        logger.setLevel(logging.INFO)
+        started = time.perf_counter()
+        for i in range(iterations):
+            logger.info("Message from user %s: %s", i, redact_text('hello'), extra={'event': 'bench'})
+        results[name] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+
+    listener.stop()
+    listeners.remove(listener)
+    return {'us_per_call': results, 'iterations': iterations, 'write_latency_us': write_latency * 1e6}
+
+if __name__ == '__main__':
+    print(json.dumps(benchmark()))
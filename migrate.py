@@ -0,0 +1,316 @@
+"""
+Bulk Migration for Nivalis
+Streams users from Replit DB and conversations from user_conversations.json
+into Postgres (or SQLite) in batches, with checkpoints, verification and an
+optional dual-write mirror for zero-downtime cutover. Data in the retention
+cold archive is merged back in, so the target holds every record in full
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_TARGET = os.environ.get('MIGRATION_TARGET') or os.environ.get('DATABASE_URL') or 'sqlite:///nivalis.db'
+# Set to a target URL to mirror every UserManager/models write into it
+DUAL_WRITE_URL = os.environ.get('DUAL_WRITE_URL')
+CHECKPOINT_FILE = os.environ.get('MIGRATION_CHECKPOINT', 'migration_checkpoint.json')
+BATCH_SIZE = 500
+CONNECT_TIMEOUT = 5
+# After a failed mirror write, skip dual-writes for this long instead of reconnecting per call
+MIRROR_RETRY_SECONDS = 60
+READ_CHUNK = 64 * 1024
+
+TABLES = {
+    'users': ('telegram_id', ['email', 'subscription_status', 'onboarding_completed', 'updated_at']),
+    'conversations': ('user_id', ['conversation_stage', 'last_interaction'])
+}
+
+def checksum(record):
+    """Stable content hash of a record"""
+    canonical = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def to_row(table, key, record):
+    _, columns = TABLES[table]
+    values = [record.get(column) for column in columns]
+    return [str(key)] + [None if v is None else str(v) for v in values] + [
+        json.dumps(record, default=str), checksum(record)
+    ]
+
+def iter_json_object(path, chunk_size=READ_CHUNK):
+    """Yield (key, value) pairs of a top-level JSON object without loading the file"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith('{'):
+            raise ValueError(f"{path} is not a JSON object")
+        buffer = buffer[1:]
+        eof = False
+
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,')
+            if buffer.startswith('}'):
+                return
+            try:
+                key, end = decoder.raw_decode(buffer)
+                rest = buffer[end:].lstrip()
+                if not rest.startswith(':'):
+                    raise json.JSONDecodeError("Expecting ':' delimiter", buffer, end)
+                rest = rest[1:].lstrip()
+                value, end = decoder.raw_decode(rest)
+                # A value ending exactly at the buffer edge may be cut short
+                if not eof and not rest[end:].strip():
+                    raise json.JSONDecodeError('Value may continue', rest, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield key, value
+            buffer = rest[end:]
+
+class SQLTarget:
+    """Relational target; Postgres for postgres:// URLs, SQLite otherwise"""
+
+    def __init__(self, url):
+        self.url = url
+        if url.startswith(('postgres://', 'postgresql://')):
+            import psycopg2
+            self.dialect = 'postgres'
+            self.conn = psycopg2.connect(url, connect_timeout=CONNECT_TIMEOUT)
+        else:
+            import sqlite3
+            self.dialect = 'sqlite'
+            self.conn = sqlite3.connect(url[len('sqlite:///'):] if url.startswith('sqlite:///') else url,
+                                        timeout=CONNECT_TIMEOUT)
+        self.create_tables()
+
+    def create_tables(self):
+        document_type = 'JSONB' if self.dialect == 'postgres' else 'TEXT'
+        cursor = self.conn.cursor()
+        for table, (key, columns) in TABLES.items():
+            column_sql = ', '.join(f"{column} TEXT" for column in columns)
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ({key} TEXT PRIMARY KEY, {column_sql}, "
+                f"data {document_type} NOT NULL, checksum TEXT NOT NULL)"
+            )
+        self.conn.commit()
+
+    def upsert(self, table, rows):
+        """Multi-row upsert of rows built by to_row()"""
+        if not rows:
+            return
+        key, columns = TABLES[table]
+        all_columns = [key] + columns + ['data', 'checksum']
+        updates = ', '.join(f"{column} = excluded.{column}" for column in all_columns[1:])
+        cursor = self.conn.cursor()
+        if self.dialect == 'postgres':
+            from psycopg2.extras import execute_values
+            execute_values(
+                cursor,
+                f"INSERT INTO {table} ({', '.join(all_columns)}) VALUES %s "
+                f"ON CONFLICT ({key}) DO UPDATE SET {updates}",
+                rows, page_size=len(rows)
+            )
+        else:
+            placeholders = ', '.join('?' for _ in all_columns)
+            cursor.executemany(
+                f"INSERT INTO {table} ({', '.join(all_columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT ({key}) DO UPDATE SET {updates}",
+                rows
+            )
+        self.conn.commit()
+
+    def checksums(self, table, keys):
+        """{key: checksum} for the given primary keys"""
+        if not keys:
+            return {}
+        key, _ = TABLES[table]
+        marker = '%s' if self.dialect == 'postgres' else '?'
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"SELECT {key}, checksum FROM {table} WHERE {key} IN ({', '.join(marker for _ in keys)})",
+            list(keys)
+        )
+        return dict(cursor.fetchall())
+
+    def count(self, table):
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return cursor.fetchone()[0]
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_user_batches(batch_size, after=None):
+    from auth import UserManager
+    from retention import with_archive
+    for page in UserManager.iter_users(batch_size, after=after):
+        yield [(user['telegram_id'], with_archive('users', user['telegram_id'], user)) for user in page]
+
+def iter_conversations():
+    """Live conversations in file order, then archived ones in user_id order"""
+    from models import CONVERSATIONS_FILE
+    from retention import iter_archived
+    live = set()
+    if os.path.exists(CONVERSATIONS_FILE):
+        for key, record in iter_json_object(CONVERSATIONS_FILE):
+            live.add(key)
+            yield key, record
+    for key, record in iter_archived('conversation'):
+        if key not in live:
+            yield key, record
+
+def iter_conversation_batches(batch_size, after=None):
+    """Batches of conversations following the key `after`
+
+    Resuming by key survives records being added or archived between runs.
+    If `after` is no longer present, everything is copied again; upserts
+    make that safe.
+    """
+    if after is not None and not any(key == after for key, _ in iter_conversations()):
+        logger.warning(f"Conversation cursor {after} is gone, copying all conversations again")
+        after = None
+
+    def remaining():
+        skipping = after is not None
+        for key, record in iter_conversations():
+            if skipping:
+                skipping = key != after
+                continue
+            yield key, record
+
+    yield from batched(remaining(), batch_size)
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return new_checkpoint()
+
+def new_checkpoint():
+    return {'users_cursor': None, 'users': 0, 'conversations_cursor': None, 'conversations': 0}
+
+def save_checkpoint(state):
+    tmp_path = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, CHECKPOINT_FILE)
+
+def run_migration(target, batch_size=BATCH_SIZE, resume=True):
+    """Copy everything into target, committing a checkpoint after each batch"""
+    state = dict(new_checkpoint(), **load_checkpoint()) if resume else new_checkpoint()
+
+    for batch in iter_user_batches(batch_size, after=state['users_cursor']):
+        target.upsert('users', [to_row('users', key, record) for key, record in batch])
+        state['users'] += len(batch)
+        state['users_cursor'] = batch[-1][0]
+        save_checkpoint(state)
+        logger.info(f"Migrated {state['users']} users")
+
+    for batch in iter_conversation_batches(batch_size, after=state['conversations_cursor']):
+        target.upsert('conversations', [to_row('conversations', key, record) for key, record in batch])
+        state['conversations'] += len(batch)
+        state['conversations_cursor'] = batch[-1][0]
+        save_checkpoint(state)
+        logger.info(f"Migrated {state['conversations']} conversations")
+
+    return state
+
+def verify_migration(target, batch_size=BATCH_SIZE):
+    """Compare row counts and per-record checksums between source and target"""
+    report = {}
+    sources = {'users': iter_user_batches(batch_size), 'conversations': iter_conversation_batches(batch_size)}
+    for table, batches in sources.items():
+        seen = 0
+        missing = []
+        mismatched = []
+        for batch in batches:
+            stored = target.checksums(table, [str(key) for key, _ in batch])
+            for key, record in batch:
+                expected = checksum(record)
+                actual = stored.get(str(key))
+                if actual is None:
+                    missing.append(str(key))
+                elif actual != expected:
+                    mismatched.append(str(key))
+            seen += len(batch)
+        target_rows = target.count(table)
+        report[table] = {
+            'source_rows': seen,
+            'target_rows': target_rows,
+            'missing': missing[:20],
+            'mismatched': mismatched[:20],
+            # Extra target rows (deleted at the source) fail verification too
+            'ok': not missing and not mismatched and seen == target_rows
+        }
+    return report
+
+_mirror = None
+_mirror_retry_at = 0
+
+def mirror_apply(table, key, operation):
+    """Run operation(target) against DUAL_WRITE_URL, never failing the caller
+
+    Writes skipped while the mirror is down are caught up by re-running
+    `migrate.py run --restart`; `verify` reports what is missing.
+    """
+    global _mirror, _mirror_retry_at
+    if not DUAL_WRITE_URL or time.monotonic() < _mirror_retry_at:
+        return
+    try:
+        if _mirror is None:
+            _mirror = SQLTarget(DUAL_WRITE_URL)
+        operation(_mirror)
+    except Exception as e:
+        logger.error(f"Dual-write to {table} failed for {key}: {e}")
+        # An aborted Postgres transaction would reject every later write
+        try:
+            _mirror.conn.rollback()
+        except Exception:
+            _mirror = None
+            _mirror_retry_at = time.monotonic() + MIRROR_RETRY_SECONDS
+            logger.error(f"Dual-write mirror unavailable, pausing mirror writes for {MIRROR_RETRY_SECONDS}s")
+
+def mirror_write(table, key, record):
+    """Dual-write hook: copy one record into DUAL_WRITE_URL"""
+    def upsert(target):
+        from retention import with_archive
+        target.upsert(table, [to_row(table, key, with_archive(table, key, record))])
+    mirror_apply(table, key, upsert)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate Nivalis data into a relational store')
+    parser.add_argument('command', choices=['run', 'verify'])
+    parser.add_argument('--target', default=MIGRATION_TARGET,
+                        help='postgres://... or sqlite:///path (default: DATABASE_URL)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help='ignore the existing checkpoint')
+    args = parser.parse_args(argv)
+
+    target = SQLTarget(args.target)
+    if args.command == 'run':
+        result = run_migration(target, args.batch_size, resume=not args.restart)
+    else:
+        result = verify_migration(target, args.batch_size)
+    print(json.dumps(result, indent=2))
+    return 0 if args.command == 'run' or all(r['ok'] for r in result.values()) else 1
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import os
 import json
 from datetime import datetime
+from migrate import mirror_write
 
 # Simple file-based storage for conversation memory
 CONVERSATIONS_FILE = "user_conversations.json"
@@ -24,6 +25,17 @@ def get_user_conversation(user_id: int):
     user_key = str(user_id)
     
     if user_key not in conversations:
+        # Idle users live in the cold archive until they come back
+        from retention import restore_user
+        restored = restore_user(user_id)
+        if restored:
+            return restored
+        
+        # Another worker may have restored it meanwhile
+        conversations = load_conversations()
+        if user_key in conversations:
+            return conversations[user_key]
+        
         conversations[user_key] = {
             'user_id': user_id,
             'skill_area': '',
@@ -36,6 +48,7 @@ def get_user_conversation(user_id: int):
             'is_complete': False
         }
         save_conversations(conversations)
+        mirror_write('conversations', user_key, conversations[user_key])
     
     return conversations[user_key]
 
@@ -44,11 +57,17 @@ def update_user_conversation(user_id: int, **kwargs):
     conversations = load_conversations()
     user_key = str(user_id)
     
+    if user_key not in conversations:
+        from retention import restore_user
+        restore_user(user_id)
+        conversations = load_conversations()
+    
     if user_key in conversations:
         for key, value in kwargs.items():
             if key in conversations[user_key]:
                 conversations[user_key][key] = value
         conversations[user_key]['last_interaction'] = datetime.utcnow().isoformat()
         save_conversations(conversations)
+        mirror_write('conversations', user_key, conversations[user_key])
     
     return conversations.get(user_key)
\ No newline at end of file
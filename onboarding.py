@@ -3,7 +3,9 @@ User Onboarding System for Nivalis
 Manages multi-step onboarding flow and data collection
 """
 from datetime import datetime
+import json
 import logging
+from profiling import traced
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +17,7 @@ class OnboardingFlow:
             'id': 'name',
             'question': 'What\'s your full name?',
             'type': 'text',
+            'placeholder': 'Enter your full name',
             'required': True,
             'validation': lambda x: len(x.strip()) >= 2
         },
@@ -22,6 +25,7 @@ class OnboardingFlow:
             'id': 'email',
             'question': 'What\'s your email address?',
             'type': 'email',
+            'placeholder': 'Enter your email',
             'required': True,
             'validation': lambda x: '@' in x and '.' in x.split('@')[1]
         },
@@ -29,6 +33,7 @@ class OnboardingFlow:
             'id': 'telegram_username',
             'question': 'What\'s your Telegram username? (without @)',
             'type': 'text',
+            'placeholder': 'Without the @ symbol',
             'required': False,
             'validation': lambda x: True
         },
@@ -169,14 +174,79 @@ class OnboardingFlow:
         
         answered = user.get('onboarding_progress', {})
         
-        for question in OnboardingFlow.QUESTIONS:
+        for question in PUBLIC_QUESTIONS:
             if question['id'] not in answered:
-                # Return a clean copy without validation function for JSON serialization
-                clean_question = {k: v for k, v in question.items() if k != 'validation'}
-                return clean_question
+                # Precompiled copy without the validation function, treat as read-only
+                return question
         
         return None  # All questions answered
     
+    @staticmethod
+    def validate_answer(question, answer):
+        """Return an error message for an invalid answer, or None"""
+        if not answer:
+            return 'This question is required' if question['required'] else None
+        
+        if question['type'] == 'multiple_choice':
+            if not isinstance(answer, list) or not all(isinstance(item, str) for item in answer):
+                return 'Choose from the listed options'
+            if not set(answer) <= set(question['options']):
+                return 'Choose from the listed options'
+        elif question['type'] == 'choice':
+            if answer not in question['options']:
+                return 'Choose one of the listed options'
+        elif not isinstance(answer, str):
+            return 'Answer must be text'
+        
+        if 'validation' in question and not question['validation'](answer):
+            return 'Invalid answer'
+        
+        return None
+    
+    @staticmethod
+    @traced('onboarding_validate')
+    def validate_answers(answers):
+        """Validate a full set of answers in one pass, returning a dict of errors"""
+        errors = {}
+        for question in OnboardingFlow.QUESTIONS:
+            error = OnboardingFlow.validate_answer(question, answers.get(question['id']))
+            if error:
+                errors[question['id']] = error
+        return errors
+    
+    @staticmethod
+    def submit_answers(telegram_id, answers):
+        """Validate and persist every onboarding answer with a single user update"""
+        from auth import UserManager
+        errors = OnboardingFlow.validate_answers(answers)
+        if errors:
+            return False, errors
+        
+        timestamp = datetime.utcnow().isoformat()
+        progress = {}
+        onboarding_data = {}
+        for question in OnboardingFlow.QUESTIONS:
+            answer = answers.get(question['id'])
+            if answer:
+                progress[question['id']] = {'answer': answer, 'timestamp': timestamp}
+                onboarding_data[question['id']] = answer
+        
+        profile_summary = OnboardingFlow.generate_profile_summary(onboarding_data)
+        user = UserManager.update_user(telegram_id, {
+            'onboarding_progress': progress,
+            'onboarding_completed': True,
+            'onboarding_data': onboarding_data,
+            'profile_summary': profile_summary,
+            'name': onboarding_data.get('name', ''),
+            'email': onboarding_data.get('email', '')
+        })
+        if not user:
+            return False, {'user': 'User not found'}
+        
+        logger.info(f"Completed batch onboarding for user {telegram_id}")
+        OnboardingFlow.send_capabilities_message(telegram_id, user)
+        return True, {}
+    
     @staticmethod
     def answer_question(telegram_id, question_id, answer):
         """Store answer to onboarding question"""
@@ -189,7 +259,7 @@ class OnboardingFlow:
         progress = user.get('onboarding_progress', {})
         
         # Find the question
-        question = next((q for q in OnboardingFlow.QUESTIONS if q['id'] == question_id), None)
+        question = QUESTIONS_BY_ID.get(question_id)
         if not question:
             return False
         
@@ -254,13 +324,14 @@ class OnboardingFlow:
         return True
     
     @staticmethod
-    def send_capabilities_message(telegram_id):
+    def send_capabilities_message(telegram_id, user=None):
         """Send capabilities overview message after onboarding completion"""
         import os
         import requests
         from auth import UserManager
         
-        user = UserManager.get_user(telegram_id)
+        if user is None:
+            user = UserManager.get_user(telegram_id)
         if not user:
             return
         
@@ -384,4 +455,12 @@ USER PROFILE CONTEXT:
 
 This user's responses should be tailored to their specific situation, experience level, and goals.
 """
-        return context.strip()
\ No newline at end of file
+        return context.strip()
+
+# Precompiled once at import: the serializable schema without validation lambdas
+PUBLIC_QUESTIONS = [
+    {k: v for k, v in question.items() if k != 'validation'}
+    for question in OnboardingFlow.QUESTIONS
+]
+QUESTIONS_BY_ID = {question['id']: question for question in OnboardingFlow.QUESTIONS}
+QUESTIONS_JSON = json.dumps({'questions': PUBLIC_QUESTIONS}, ensure_ascii=False).encode('utf-8')
@@ -0,0 +1,280 @@
+"""
+Long-Polling Runner for Nivalis
+Alternative to /telegram-webhook: fetches updates in batches with getUpdates
+and feeds them to the same handler, with no public URL required.
+`python polling.py --benchmark 2000` compares both paths against a fake Bot API
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+POLL_LIMIT = 100  # Bot API maximum per getUpdates call
+WEBHOOK_CONNECTIONS = 40  # Telegram's default max_connections for webhooks
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', 50))
+OFFSET_FILE = os.environ.get('POLL_OFFSET_FILE', 'polling_offset.json')
+
+class UpdatePoller:
+    """Fetch, dispatch, then commit: the offset only advances past handled updates"""
+
+    def __init__(self, bot_token, handler, api_url='https://api.telegram.org',
+                 limit=POLL_LIMIT, timeout=POLL_TIMEOUT, offset_file=OFFSET_FILE):
+        import requests
+        self.base_url = f"{api_url}/bot{bot_token}"
+        self.handler = handler
+        self.limit = limit
+        self.timeout = timeout
+        self.offset_file = offset_file
+        self.http = requests.Session()
+        self.offset = self.load_offset()
+
+    def load_offset(self):
+        if not self.offset_file:
+            return None
+        try:
+            with open(self.offset_file, 'r') as f:
+                return json.load(f).get('offset')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def commit_offset(self):
+        """Persist the next offset; Telegram drops older updates on the next call"""
+        if self.offset_file:
+            tmp_path = f"{self.offset_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'offset': self.offset}, f)
+            os.replace(tmp_path, self.offset_file)
+
+    def delete_webhook(self):
+        """getUpdates is refused while a webhook is registered"""
+        response = self.http.post(f"{self.base_url}/deleteWebhook", timeout=10)
+        return response.ok
+
+    def fetch(self):
+        params = {'limit': self.limit, 'timeout': self.timeout, 'allowed_updates': ['message']}
+        if self.offset is not None:
+            params['offset'] = self.offset
+        response = self.http.post(f"{self.base_url}/getUpdates", json=params,
+                                  timeout=self.timeout + 10)
+        data = response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"getUpdates failed: {data.get('description')}")
+        return data['result']
+
+    def process(self, updates):
+        for update in updates:
+            try:
+                self.handler(update)
+            except Exception as e:
+                logger.error(f"Polling handler error for update {update.get('update_id')}: {e}")
+            # Per update, so a crash mid-batch never replays updates already answered
+            self.offset = update['update_id'] + 1
+            self.commit_offset()
+
+    def run(self, max_batches=None):
+        """Poll until interrupted (or max_batches), returning throughput stats"""
+        batches = 0
+        handled = 0
+        started = time.monotonic()
+        try:
+            while max_batches is None or batches < max_batches:
+                try:
+                    updates = self.fetch()
+                except Exception as e:
+                    logger.error(f"Polling error: {e}")
+                    time.sleep(1)
+                    continue
+                self.process(updates)
+                batches += 1
+                handled += len(updates)
+        except KeyboardInterrupt:
+            logger.info("Polling stopped")
+
+        elapsed = time.monotonic() - started
+        return {
+            'batches': batches,
+            'updates': handled,
+            'seconds': round(elapsed, 3),
+            'updates_per_second': round(handled / elapsed, 1) if elapsed else 0
+        }
+
+class LocalServer(ThreadingHTTPServer):
+    """Loopback server that keeps up with WEBHOOK_CONNECTIONS concurrent clients"""
+    daemon_threads = True
+    request_queue_size = 128
+
+def fake_update(update_id):
+    chat = {'id': 100000 + update_id % 500, 'type': 'private'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'chat': chat, 'from': {'id': chat['id'], 'first_name': 'Bench'},
+        'date': int(time.time()), 'text': f"benchmark message {update_id}"
+    }}
+
+class FakeBotAPI:
+    """Local stand-in for the Bot API serving getUpdates, sendMessage and deleteWebhook"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.pending = deque()
+        self.sent = 0
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                params = json.loads(self.rfile.read(length) or b'{}')
+                body = json.dumps(api.call(method, params)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = LocalServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def enqueue(self, count):
+        with self.lock:
+            self.pending.extend(fake_update(update_id) for update_id in range(1, count + 1))
+
+    def call(self, method, params):
+        time.sleep(self.latency)
+        with self.lock:
+            if method == 'getUpdates':
+                # Like Telegram, an offset confirms (drops) every earlier update
+                offset = params.get('offset')
+                while offset is not None and self.pending and self.pending[0]['update_id'] < offset:
+                    self.pending.popleft()
+                return {'ok': True, 'result': list(self.pending)[:params.get('limit', POLL_LIMIT)]}
+            if method == 'sendMessage':
+                self.sent += 1
+                return {'ok': True, 'result': {'message_id': self.sent, 'chat': {'id': params.get('chat_id')}}}
+            if method == 'deleteWebhook':
+                return {'ok': True, 'result': True}
+        return {'ok': False, 'description': f"Not Found: method {method}"}
+
+def replying_handler(api_url, bot_token):
+    """Handler doing what handle_update does on the wire: one sendMessage per update"""
+    import requests
+    local = threading.local()
+
+    def handle(update):
+        if not hasattr(local, 'http'):
+            local.http = requests.Session()
+        local.http.post(f"{api_url}/bot{bot_token}/sendMessage", timeout=10, json={
+            'chat_id': update['message']['chat']['id'], 'text': 'ok'
+        })
+    return handle
+
+def benchmark_webhook(updates, handler, latency, connections=WEBHOOK_CONNECTIONS):
+    """Telegram POSTs each update to the bot over up to `connections` connections"""
+    import requests
+
+    class Receiver(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            handler(json.loads(self.rfile.read(length)))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = LocalServer(('127.0.0.1', 0), Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/telegram-webhook"
+    local = threading.local()
+
+    def deliver(update):
+        if not hasattr(local, 'http'):
+            local.http = requests.Session()
+        time.sleep(latency)
+        local.http.post(url, json=update, timeout=10)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        list(pool.map(deliver, updates))
+    elapsed = time.monotonic() - started
+    server.shutdown()
+    server.server_close()
+    return {'updates': len(updates), 'seconds': round(elapsed, 3),
+            'updates_per_second': round(len(updates) / elapsed, 1) if elapsed else 0}
+
+def benchmark(count=2000, latency=0.02, limit=POLL_LIMIT):
+    """Updates per second through the webhook path vs getUpdates batches, against FakeBotAPI"""
+    results = {}
+    api = FakeBotAPI(latency)
+    try:
+        handler = replying_handler(api.url, 'bench')
+        updates = [fake_update(update_id) for update_id in range(1, count + 1)]
+        results['webhook'] = benchmark_webhook(updates, handler, latency)
+        # One connection processes in order, like the poller does
+        results['webhook_serial'] = benchmark_webhook(updates, handler, latency, connections=1)
+
+        api.enqueue(count)
+        poller = UpdatePoller('bench', handler, api_url=api.url, limit=limit, timeout=0, offset_file=None)
+        results['polling'] = poller.run(max_batches=-(-count // limit))
+        results['replies_sent'] = api.sent
+    finally:
+        api.close()
+    results.update({'latency_ms': latency * 1000, 'limit': limit})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the Nivalis bot with long polling')
+    parser.add_argument('--delete-webhook', action='store_true',
+                        help='remove the registered webhook before polling')
+    parser.add_argument('--limit', type=int, default=POLL_LIMIT)
+    parser.add_argument('--timeout', type=int, default=POLL_TIMEOUT)
+    parser.add_argument('--max-batches', type=int, help='stop after this many getUpdates calls')
+    parser.add_argument('--benchmark', type=int, metavar='UPDATES',
+                        help='compare webhook and polling throughput against a fake Bot API and exit')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='simulated network round trip in seconds for --benchmark')
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        print(json.dumps(benchmark(args.benchmark, args.latency, args.limit)))
+        return 0
+
+    from web import dispatch_update, TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL
+    if not TELEGRAM_BOT_TOKEN:
+        parser.error('TELEGRAM_BOT_TOKEN is not set')
+
+    poller = UpdatePoller(TELEGRAM_BOT_TOKEN, dispatch_update, api_url=TELEGRAM_API_URL,
+                          limit=args.limit, timeout=args.timeout)
+    if args.delete_webhook:
+        poller.delete_webhook()
+
+    logger.info(f"Polling for updates (limit {args.limit}, timeout {args.timeout}s)")
+    print(json.dumps(poller.run(args.max_batches)))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Runtime Profiling for Nivalis
+On-demand sampling profiler with collapsed-stack output and span
+breakdowns for slow requests
+"""
+import os
+import sys
+import hmac
+import time
+import signal
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import request, jsonify
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+PROFILER_SIGNAL = os.environ.get('PROFILER_SIGNAL', 'SIGUSR2')
+MAX_PROFILE_SECONDS = 300
+
+# Spans recorded for the current request, None when nothing is being traced
+current_spans = ContextVar('current_spans', default=None)
+
+class SamplingProfiler:
+    """Samples every thread's stack from a background thread"""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, max_seconds=MAX_PROFILE_SECONDS):
+        if self.running:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.run, args=(max_seconds,),
+                                       name='nivalis-profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stop sampling and return the collapsed stacks"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.collapsed()
+
+    def run(self, max_seconds):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not self.stopping.wait(self.interval) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[self.collapse(frame)] += 1
+            self.samples += 1
+
+        # Nobody asked this worker to stop (the stop request may have reached
+        # another worker), so keep the samples on disk rather than losing them
+        if not self.stopping.is_set():
+            path = write_profile(self.collapsed())
+            logger.info(f"Profiler reached its {max_seconds}s limit, {self.samples} samples written to {path}")
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        """Brendan Gregg's folded format, ready for flamegraph.pl or speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+profiler = SamplingProfiler()
+
+@contextmanager
+def span(name):
+    """Time a block when the current request is being traced"""
+    spans = current_spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, round((time.perf_counter() - started) * 1000, 2)))
+
+def traced(name):
+    """Decorator form of span()"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def require_admin(f):
+    """Require the X-Admin-Token header to match ADMIN_TOKEN"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'success': False, 'message': 'Not found'}), 404
+        return f(*args, **kwargs)
+    return decorated_function
+
+def write_profile(collapsed):
+    path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}.folded")
+    with open(path, 'w') as f:
+        f.write(collapsed)
+    return path
+
+def toggle_profiler(signum=None, frame=None):
+    """Signal handler: first signal starts sampling, the next dumps to PROFILE_DIR"""
+    if profiler.running:
+        path = write_profile(profiler.stop())
+        logger.info(f"Profiler stopped, {profiler.samples} samples written to {path}")
+    else:
+        profiler.start()
+        logger.info(f"Profiler started in worker {os.getpid()}")
+
+def install_signal_handler():
+    """Call from the worker's main thread (gunicorn post_worker_init)"""
+    signal.signal(getattr(signal, PROFILER_SIGNAL), toggle_profiler)
+
+class RequestTimer:
+    """WSGI middleware stamping when the request reached the app"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ['nivalis.request_start'] = time.perf_counter()
+        return self.wsgi_app(environ, start_response)
+
+def start_trace():
+    spans = []
+    started = request.environ.get('nivalis.request_start')
+    if started is not None:
+        spans.append(('routing', round((time.perf_counter() - started) * 1000, 2)))
+    request.environ['nivalis.spans'] = spans
+    request.environ['nivalis.trace_token'] = current_spans.set(spans)
+
+def finish_trace(response):
+    spans = request.environ.get('nivalis.spans')
+    started = request.environ.get('nivalis.request_start')
+    if spans is None or started is None:
+        return response
+
+    total_ms = (time.perf_counter() - started) * 1000
+    if total_ms >= SLOW_REQUEST_MS:
+        accounted = sum(duration for _, duration in spans)
+        logger.warning(
+            "Slow request %s %s took %.1fms", request.method, request.path, total_ms,
+            extra={
+                'event': 'slow_request',
+                'endpoint': request.endpoint,
+                'duration_ms': round(total_ms, 2),
+                'spans': spans + [('other', round(total_ms - accounted, 2))]
+            }
+        )
+    return response
+
+def reset_trace(exc=None):
+    token = request.environ.pop('nivalis.trace_token', None)
+    if token is not None:
+        current_spans.reset(token)
+
+def profiler_start():
+    """Start sampling this worker; the profile lands in PROFILE_DIR if no stop reaches it"""
+    try:
+        seconds = float(request.args.get('max_seconds', MAX_PROFILE_SECONDS))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'max_seconds must be a number'}), 400
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return jsonify({'success': False,
+                        'message': f"max_seconds must be between 0 and {MAX_PROFILE_SECONDS}"}), 400
+    started = profiler.start(seconds)
+    return jsonify({'success': started, 'pid': os.getpid(), 'running': profiler.running,
+                    'max_seconds': seconds, 'profile_dir': PROFILE_DIR})
+
+def profiler_stop():
+    """Stop sampling and return collapsed stacks as text"""
+    if not profiler.running:
+        # With several workers the stop often lands elsewhere than the start did
+        return jsonify({'success': False, 'pid': os.getpid(),
+                        'message': f"Profiler is not running in this worker; timed-out "
+                                   f"profiles are written to {PROFILE_DIR}"}), 409
+    collapsed = profiler.stop()
+    return collapsed, 200, {'Content-Type': 'text/plain; charset=utf-8',
+                            'X-Profile-Samples': str(profiler.samples),
+                            'X-Profile-Pid': str(os.getpid())}
+
+def init_app(app):
+    """Register slow-request tracing and the admin profiler routes"""
+    app.wsgi_app = RequestTimer(app.wsgi_app)
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+    app.teardown_request(reset_trace)
+    app.add_url_rule('/admin/profiler/start', 'profiler_start',
+                     require_admin(profiler_start), methods=['POST'])
+    app.add_url_rule('/admin/profiler/stop', 'profiler_stop',
+                     require_admin(profiler_stop), methods=['POST'])
@@ -0,0 +1,228 @@
+"""
+Conversation Retention for Nivalis
+Trims chat histories and moves idle users into a compressed cold archive
+that is restored lazily on their next message
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+import threading
+import logging
+from datetime import datetime, timedelta
+from migrate import mirror_write
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+HISTORY_LIMIT = int(os.environ.get('HISTORY_LIMIT', 50))
+IDLE_TTL_DAYS = int(os.environ.get('IDLE_TTL_DAYS', 30))
+
+def archive_path(user_id):
+    return os.path.join(ARCHIVE_DIR, f"{user_id}.json.gz")
+
+def write_archive(user_id, record):
+    """Merge record into the user's archive file"""
+    existing = read_archive(user_id) or {}
+    if existing.get('chat_history') and record.get('chat_history'):
+        record['chat_history'] = existing['chat_history'] + record['chat_history']
+    existing.update(record)
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp_path = f"{archive_path(user_id)}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(existing, f, default=str)
+    os.replace(tmp_path, archive_path(user_id))
+
+def read_archive(user_id, path=None):
+    try:
+        with gzip.open(path or archive_path(user_id), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def discard_archived(user_id, field):
+    """Drop one field from the user's archive, removing the file once it is empty"""
+    existing = read_archive(user_id)
+    if existing is None or field not in existing:
+        return
+    existing.pop(field)
+    if not existing:
+        os.remove(archive_path(user_id))
+        return
+    tmp_path = f"{archive_path(user_id)}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(existing, f, default=str)
+    os.replace(tmp_path, archive_path(user_id))
+
+def iter_archived(field):
+    """(user_id, value) for every archive holding field, in user_id order"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if name.endswith('.json.gz'):
+            user_id = name[:-len('.json.gz')]
+            record = read_archive(user_id) or {}
+            if field in record:
+                yield user_id, record[field]
+
+def with_archive(table, key, record):
+    """The record as if nothing were archived; what migration targets store"""
+    if table != 'users' or not record.get('history_archived'):
+        return record
+    archived = read_archive(key) or {}
+    merged = {k: v for k, v in record.items() if k != 'history_archived'}
+    merged['chat_history'] = archived.get('chat_history', []) + record.get('chat_history', [])
+    return merged
+
+def is_idle(timestamp, cutoff):
+    if not timestamp:
+        return False
+    try:
+        return datetime.fromisoformat(timestamp) < cutoff
+    except ValueError:
+        return False
+
+def trim_history(history, limit=HISTORY_LIMIT):
+    """Keep the newest messages, returning (kept, dropped)"""
+    if len(history) <= limit:
+        return history, []
+    return history[-limit:], history[:-limit]
+
+def restore_user(user_id):
+    """Bring an archived user back into the hot stores; returns the conversation
+
+    The archive is claimed with a rename first, so when two workers race only
+    one merges it and the other sees it as already restored (None).
+    """
+    claimed_path = f"{archive_path(user_id)}.{os.getpid()}-{threading.get_ident()}.restoring"
+    try:
+        os.replace(archive_path(user_id), claimed_path)
+    except FileNotFoundError:
+        return None
+
+    try:
+        record = read_archive(user_id, claimed_path) or {}
+        conversation = merge_restored(user_id, record)
+    except Exception:
+        # Hand the archive back so the next access can retry
+        os.replace(claimed_path, archive_path(user_id))
+        raise
+
+    os.remove(claimed_path)
+    logger.info(f"Restored user {user_id} from cold archive")
+    return conversation
+
+def merge_restored(user_id, record):
+    from models import load_conversations, save_conversations
+    conversation = record.get('conversation')
+    if conversation:
+        conversation['last_interaction'] = datetime.utcnow().isoformat()
+        conversations = load_conversations()
+        conversation = conversations.setdefault(str(user_id), conversation)
+        save_conversations(conversations)
+        mirror_write('conversations', str(user_id), conversation)
+
+    if 'chat_history' in record:
+        from auth import db
+        user_key = f"user:{user_id}"
+        user = db.get(user_key)
+        if user:
+            # Archives hold at most HISTORY_LIMIT entries; any overflow is counted, not silently lost
+            kept, dropped = trim_history(record['chat_history'] + user.get('chat_history', []))
+            user['chat_history'] = kept
+            if dropped:
+                user['chat_history_trimmed'] = user.get('chat_history_trimmed', 0) + len(dropped)
+            user.pop('history_archived', None)
+            db[user_key] = user
+            mirror_write('users', user_id, user)
+    return conversation
+
+def compact(now=None, idle_days=IDLE_TTL_DAYS, history_limit=HISTORY_LIMIT, dry_run=False):
+    """Trim long histories and archive users idle for longer than idle_days"""
+    from auth import UserManager, db
+    from models import load_conversations, save_conversations
+
+    cutoff = (now or datetime.utcnow()) - timedelta(days=idle_days)
+    stats = {'trimmed': 0, 'archived': 0, 'conversations_archived': 0}
+
+    # Conversations are archived from a snapshot, so the slow gzip writes happen
+    # while workers keep updating user_conversations.json
+    snapshot = load_conversations()
+    last_seen = {user_id: record.get('last_interaction') for user_id, record in snapshot.items()}
+    idle_ids = [user_id for user_id, record in snapshot.items()
+                if is_idle(record.get('last_interaction'), cutoff)]
+    if not dry_run:
+        for user_id in idle_ids:
+            write_archive(user_id, {'conversation': snapshot[user_id]})
+
+        # One short read-modify-write removes only records that are still idle and unchanged
+        conversations = load_conversations()
+        archived = [user_id for user_id in idle_ids if conversations.get(user_id) == snapshot[user_id]]
+        for user_id in archived:
+            conversations.pop(user_id)
+        if archived:
+            save_conversations(conversations)
+
+        # Users who came back meanwhile stay hot; their archived copy is stale
+        for user_id in set(idle_ids) - set(archived):
+            discard_archived(user_id, 'conversation')
+            last_seen[user_id] = (conversations.get(user_id) or {}).get('last_interaction')
+        idle_ids = archived
+    stats['conversations_archived'] = len(idle_ids)
+
+    # User records, streamed a page at a time
+    for page in UserManager.iter_users():
+        for user in page:
+            user_id = user['telegram_id']
+            # User records are only touched on profile changes; chat activity lives on the conversation
+            seen = last_seen.get(str(user_id)) or user.get('updated_at')
+            idle = is_idle(seen, cutoff)
+            history = user.get('chat_history', [])
+            if not history or (not idle and len(history) <= history_limit):
+                continue
+            if dry_run:
+                stats['archived' if idle else 'trimmed'] += 1
+                continue
+
+            # Re-read right before writing so concurrent update_user changes survive,
+            # and write straight to db so updated_at (and idleness) is left untouched
+            user_key = f"user:{user_id}"
+            user = db.get(user_key)
+            if not user:
+                continue
+            kept, dropped = trim_history(user.get('chat_history', []), history_limit)
+            if idle and kept:
+                # Trimmed first so restore_user can bring back the whole archive
+                write_archive(user_id, {'chat_history': kept})
+                user['chat_history'] = []
+                user['history_archived'] = True
+                stats['archived'] += 1
+            elif dropped:
+                user['chat_history'] = kept
+                stats['trimmed'] += 1
+            else:
+                continue
+            if dropped:
+                user['chat_history_trimmed'] = user.get('chat_history_trimmed', 0) + len(dropped)
+            db[user_key] = user
+            mirror_write('users', user_id, user)
+
+    logger.info(f"Retention compaction finished: {stats}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compact and archive Nivalis conversation data')
+    parser.add_argument('--idle-days', type=int, default=IDLE_TTL_DAYS)
+    parser.add_argument('--history-limit', type=int, default=HISTORY_LIMIT)
+    parser.add_argument('--dry-run', action='store_true', help='report without changing data')
+    args = parser.parse_args(argv)
+
+    stats = compact(idle_days=args.idle_days, history_limit=args.history_limit, dry_run=args.dry_run)
+    print(json.dumps(stats))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
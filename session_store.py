@@ -0,0 +1,226 @@
+"""
+Server-Side Session Store for Nivalis
+Keeps session data in SQLite (or Replit DB) and sends only a compact
+session id cookie to the browser
+"""
+import os
+import time
+import secrets
+import sqlite3
+import threading
+import logging
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+
+logger = logging.getLogger(__name__)
+
+# sqlite is node-local; clustered deployments default to the shared replit store
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+
+# Seconds between opportunistic purges of expired sessions, per process
+GC_INTERVAL = 300
+
+serializer = TaggedJSONSerializer()
+
+class SQLiteSessionStore:
+    """Session rows in a local SQLite file, one connection per thread"""
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def load(self, sid):
+        row = self.connection().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND expires > ?', (sid, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, expires):
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+                (sid, data, expires)
+            )
+
+    def delete(self, sid):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def purge_expired(self):
+        with self.connection() as conn:
+            return conn.execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),)).rowcount
+
+class ReplitSessionStore:
+    """Session records stored as session:{sid} keys in Replit DB"""
+
+    def __init__(self):
+        from replit import db
+        self.db = db
+
+    def load(self, sid):
+        record = self.db.get(f"session:{sid}")
+        if not record or record.get('expires', 0) <= time.time():
+            return None
+        return record['data']
+
+    def save(self, sid, data, expires):
+        self.db[f"session:{sid}"] = {'data': data, 'expires': expires}
+
+    def delete(self, sid):
+        key = f"session:{sid}"
+        if key in self.db:
+            del self.db[key]
+
+    def purge_expired(self):
+        now = time.time()
+        removed = 0
+        for key in self.db.prefix('session:'):
+            record = self.db.get(key)
+            if not record or record.get('expires', 0) <= now:
+                del self.db[key]
+                removed += 1
+        return removed
+
+class ServerSession(SessionMixin):
+    """Session whose data is only fetched from the store on first access"""
+
+    def __init__(self, store, sid, new=False):
+        self.store = store
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self._data = {} if new else None
+
+    @property
+    def data(self):
+        self.accessed = True
+        if self._data is None:
+            raw = self.store.load(self.sid)
+            if raw:
+                self._data = serializer.loads(raw)
+            else:
+                # Never adopt an unknown client-supplied id
+                self.sid = secrets.token_urlsafe(24)
+                self.new = True
+                self._data = {}
+        return self._data
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self._data = {}
+        self.accessed = True
+        self.modified = True
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface backed by a server-side store"""
+
+    def __init__(self, store=None):
+        self.store = store
+        self.last_gc = 0.0
+
+    def get_store(self):
+        if self.store is None:
+            from sharding import router
+            backend = SESSION_BACKEND or ('replit' if router.enabled else 'sqlite')
+            if backend == 'replit':
+                self.store = ReplitSessionStore()
+            else:
+                if router.enabled:
+                    logger.warning("SESSION_BACKEND=sqlite with clustering enabled: sessions are "
+                                   "node-local and will be lost when requests change nodes")
+                self.store = SQLiteSessionStore()
+        return self.store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            return ServerSession(self.get_store(), sid)
+        return ServerSession(self.get_store(), secrets.token_urlsafe(24), new=True)
+
+    def collect_garbage(self):
+        """Drop expired sessions at most once per GC_INTERVAL"""
+        now = time.time()
+        if now - self.last_gc < GC_INTERVAL:
+            return
+        self.last_gc = now
+        try:
+            removed = self.get_store().purge_expired()
+            if removed:
+                logger.info(f"Purged {removed} expired sessions")
+        except Exception as e:
+            logger.error(f"Session purge error: {e}")
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # Requests that never touched the session do no storage work at all
+        if not session.loaded:
+            return
+
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.get_store().delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        # Server-side rows always expire after the configured lifetime
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.get_store().save(session.sid, serializer.dumps(dict(session)), time.time() + lifetime)
+        self.collect_garbage()
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            partitioned=self.get_cookie_partitioned(app),
+        )
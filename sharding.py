@@ -0,0 +1,211 @@
+"""
+Chat-Affinity Sharding for Nivalis
+Consistent hashing of chat_id across bot nodes so each chat is handled,
+cached and ordered by a single owner
+"""
+import os
+import json
+import hmac
+import time
+import queue
+import atexit
+import bisect
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+NODE_ID = os.environ.get('NODE_ID', '')
+# "node-a=http://10.0.0.1:5000,node-b=http://10.0.0.2:5000"
+CLUSTER_NODES = os.environ.get('CLUSTER_NODES', '')
+# Optional JSON file {"node-a": "http://...", ...}, re-read when it changes
+CLUSTER_NODES_FILE = os.environ.get('CLUSTER_NODES_FILE')
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '')
+VIRTUAL_NODES = 160
+FORWARD_HEADER = 'X-Nivalis-Forwarded'
+FORWARD_CONNECT_TIMEOUT = 2
+FORWARD_TIMEOUT = 5
+# Forwarded updates waiting for this worker's background thread; beyond this they run inline
+FORWARD_QUEUE_SIZE = int(os.environ.get('FORWARD_QUEUE_SIZE', 100))
+FORWARD_DRAIN_SECONDS = 25
+
+def ring_position(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent hash ring with virtual nodes; a membership change moves ~1/N keys"""
+
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (ring_position(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        self.positions = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.positions:
+            return None
+        index = bisect.bisect(self.positions, ring_position(str(key))) % len(self.positions)
+        return self.owners[index]
+
+def parse_nodes(spec):
+    nodes = {}
+    for item in spec.split(','):
+        if '=' in item:
+            node_id, url = item.split('=', 1)
+            nodes[node_id.strip()] = url.strip().rstrip('/')
+    return nodes
+
+def update_chat_id(update):
+    """chat_id of a Telegram update, or None"""
+    for field in ('message', 'edited_message', 'channel_post', 'callback_query'):
+        item = update.get(field)
+        if not item:
+            continue
+        if field == 'callback_query':
+            item = item.get('message') or {}
+        chat = item.get('chat')
+        if chat:
+            return chat.get('id')
+    return None
+
+class ClusterRouter:
+    """Decides whether this node owns a chat and forwards updates it doesn't"""
+
+    def __init__(self, node_id=NODE_ID, nodes=None, nodes_file=CLUSTER_NODES_FILE,
+                 secret=CLUSTER_SECRET):
+        self.node_id = node_id
+        self.nodes_file = nodes_file
+        self.nodes_mtime = None
+        self.secret = secret
+        self.http = None
+        self.set_nodes(nodes if nodes is not None else parse_nodes(CLUSTER_NODES))
+
+    def set_nodes(self, nodes):
+        self.nodes = dict(nodes)
+        self.ring = HashRing(self.nodes)
+
+    def refresh(self):
+        """Pick up membership changes from CLUSTER_NODES_FILE"""
+        if not self.nodes_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.nodes_file)
+            if mtime == self.nodes_mtime:
+                return
+            with open(self.nodes_file, 'r') as f:
+                self.set_nodes(json.load(f))
+            self.nodes_mtime = mtime
+            logger.info(f"Cluster membership updated: {sorted(self.nodes)}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Cluster membership reload error: {e}")
+
+    @property
+    def enabled(self):
+        return bool(self.node_id and self.secret) and len(self.nodes) > 1
+
+    def owner(self, chat_id):
+        self.refresh()
+        return self.ring.owner(chat_id)
+
+    def is_forwarded(self, headers):
+        """True for a request another node already routed to us"""
+        token = headers.get(FORWARD_HEADER)
+        return bool(token) and hmac.compare_digest(token, self.secret)
+
+    def forward(self, update):
+        """Send the update to its owner; False means handle it locally
+
+        Only failures that prove the owner never received the update fall back
+        to local handling. A read timeout means the owner may still be working
+        on it, so it counts as delivered rather than risking a double reply.
+        """
+        if not self.enabled:
+            return False
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return False
+
+        owner = self.owner(chat_id)
+        if owner is None or owner == self.node_id:
+            return False
+
+        import requests
+        if self.http is None:
+            self.http = requests.Session()
+        try:
+            response = self.http.post(f"{self.nodes[owner]}/telegram-webhook", json=update,
+                                      headers={FORWARD_HEADER: self.secret},
+                                      timeout=(FORWARD_CONNECT_TIMEOUT, FORWARD_TIMEOUT))
+        except requests.exceptions.ReadTimeout:
+            logger.warning(f"Forward to {owner} timed out waiting for a reply, assuming delivered")
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Forward to {owner} failed ({e}), handling locally")
+            return False
+
+        if response.ok:
+            return True
+        logger.warning(f"Forward to {owner} failed with {response.status_code}, handling locally")
+        return False
+
+class ForwardedQueue:
+    """Background handling of updates forwarded to this node
+
+    The owner acknowledges a forwarded update once it is queued, so the
+    forwarding node's worker is released at once instead of waiting out the
+    reply (OpenAI round trip included). One thread per worker process keeps
+    the updates in arrival order.
+    """
+
+    def __init__(self, handler, maxsize=FORWARD_QUEUE_SIZE):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, update):
+        """Queue the update; False when full and the caller should handle it inline"""
+        self.ensure_thread()
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def ensure_thread(self):
+        with self.lock:
+            # Started lazily so each forked worker gets its own queue and thread
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(self.maxsize)
+                    self.pid = os.getpid()
+                    atexit.register(self.drain)
+                self.thread = threading.Thread(target=self.run, name='nivalis-forwarded', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            update = self.queue.get()
+            try:
+                self.handler(update)
+            except Exception as e:
+                logger.error(f"Forwarded update {update.get('update_id')} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def drain(self, timeout=FORWARD_DRAIN_SECONDS):
+        """Give queued updates a chance to finish before the worker exits"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self.queue.unfinished_tasks:
+            logger.warning(f"Worker exiting with {self.queue.unfinished_tasks} forwarded updates unhandled")
+
+router = ClusterRouter()
@@ -0,0 +1,139 @@
+"""
+Static Asset Pipeline for Nivalis
+Fingerprints and precompresses static files at startup and caches
+rendered bytes for data-free pages
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+import logging
+from flask import request, render_template, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Anything smaller is not worth a compressed variant
+MIN_COMPRESS_SIZE = 512
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PAGE_CACHE_CONTROL = 'no-cache'
+
+class CompressedAsset:
+    """Identity, gzip and brotli encodings of one body, each with its own strong ETag"""
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.etag = self.digest[:16]
+        self.variants = {'identity': body}
+
+        if len(body) >= MIN_COMPRESS_SIZE:
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body, quality=11)
+
+        # Different content-codings are different representations (RFC 9110 8.8.3)
+        self.etags = {
+            encoding: self.etag if encoding == 'identity' else f"{self.etag}-{encoding}"
+            for encoding in self.variants
+        }
+
+    def choose_encoding(self):
+        """Pick the smallest variant the client accepts"""
+        accepted = request.accept_encodings
+        best = 'identity'
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted[encoding]:
+                if len(self.variants[encoding]) < len(self.variants[best]):
+                    best = encoding
+        return best
+
+    def respond(self, app, cache_control):
+        """Serve the negotiated variant, or 304 when the client holds any variant"""
+        encoding = self.choose_encoding()
+        etag = self.etags[encoding]
+        current = [tag for tag in self.etags.values() if request.if_none_match.contains(tag)]
+        if current:
+            # Echo the validator the client holds so its stored encoding is the one refreshed
+            etag = etag if etag in current else current[0]
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+def fingerprinted_name(filename, digest):
+    """style.css -> style.<digest>.css"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest[:12]}{ext}"
+
+class StaticPipeline:
+    """Serves fingerprinted, precompressed static files and cached pages"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.urls = {}      # logical filename -> fingerprinted filename
+        self.assets = {}    # fingerprinted filename -> CompressedAsset
+        self.pages = {}     # template name -> CompressedAsset
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Build the manifest and take over the app's static endpoint"""
+        self.app = app
+        self.build(app.static_folder)
+        app.url_defaults(self.fingerprint_url)
+        app.view_functions['static'] = self.serve_static
+        app.extensions['static_pipeline'] = self
+
+    def build(self, static_folder):
+        """Fingerprint and compress every file under the static folder"""
+        self.urls.clear()
+        self.assets.clear()
+        if not static_folder or not os.path.isdir(static_folder):
+            return
+
+        for dirpath, _, filenames in os.walk(static_folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    body = f.read()
+
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                asset = CompressedAsset(body, mimetype)
+                hashed = fingerprinted_name(filename, asset.digest)
+                self.urls[filename] = hashed
+                self.assets[hashed] = asset
+
+        logger.info(f"Static pipeline prepared {len(self.assets)} assets (brotli: {brotli is not None})")
+
+    def fingerprint_url(self, endpoint, values):
+        """Point url_for('static', ...) at the fingerprinted filename"""
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.urls.get(values['filename'], values['filename'])
+
+    def serve_static(self, filename):
+        """Static view: immutable fingerprinted assets, plain fallback otherwise"""
+        asset = self.assets.get(filename)
+        if asset is None:
+            return send_from_directory(self.app.static_folder, filename)
+        return asset.respond(self.app, IMMUTABLE_CACHE_CONTROL)
+
+    def render_page(self, template_name):
+        """Render a data-free template once and serve the cached bytes"""
+        page = self.pages.get(template_name)
+        if page is None:
+            body = render_template(template_name).encode('utf-8')
+            page = CompressedAsset(body, 'text/html')
+            self.pages[template_name] = page
+        return page.respond(self.app, PAGE_CACHE_CONTROL)
@@ -6,20 +6,38 @@ Replace your GitHub web.py with this exact code
 
 import os
 import json
+import hashlib
 import logging
-from flask import Flask, request, jsonify, render_template, session, redirect
+from flask import Flask, request, jsonify, render_template, session, redirect, g
 from datetime import datetime
+from jwt_utils import require_auth, verify_token
+from log_config import configure_logging, redact_text
+from profiling import span, init_app as init_profiling
+from sharding import router, ForwardedQueue
+from static_assets import StaticPipeline, CompressedAsset
+from onboarding import OnboardingFlow, QUESTIONS_JSON
+from session_store import ServerSessionInterface
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (queued, JSON, off the request path)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "nivalis-2025")
 
+# Session data lives server-side; the cookie only carries a session id
+app.session_interface = ServerSessionInterface()
+
+# Slow-request span capture and the admin sampling profiler
+init_profiling(app)
+
+# Fingerprinted, precompressed static files and cached static pages
+static_pipeline = StaticPipeline(app)
+
 # Bot configuration
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 
@@ -33,7 +51,7 @@ def send_telegram_message(chat_id, text):
     
     import requests
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         'chat_id': chat_id,
         'text': text,
@@ -41,7 +59,8 @@ def send_telegram_message(chat_id, text):
     }
     
     try:
-        response = requests.post(url, json=payload, timeout=5)
+        with span('telegram_send'):
+            response = requests.post(url, json=payload, timeout=5)
         return response.status_code == 200
     except:
         return False
@@ -53,6 +72,16 @@ def is_subscriber(user_id):
     except:
         return False
 
+def get_methodology_context(user_message):
+    """Retrieved methodology chunks for the prompt, or '' without an index"""
+    try:
+        from knowledge import get_index
+        index = get_index()
+        return index.build_context(user_message) if index else ''
+    except Exception as e:
+        logger.error(f"Knowledge retrieval error: {e}")
+        return ''
+
 def get_ai_response(user_message, user_id):
     """Get AI response from OpenAI"""
     if not OPENAI_API_KEY:
@@ -62,15 +91,22 @@ def get_ai_response(user_message, user_id):
         from openai import OpenAI
         client = OpenAI(api_key=OPENAI_API_KEY)
         
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are Nivalis, Antonio's digital clone - a business strategist who helps users transform skills into high-ticket offers."},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=800,
-            temperature=0.7
-        )
+        with span('prompt_build'):
+            system_prompt = "You are Nivalis, Antonio's digital clone - a business strategist who helps users transform skills into high-ticket offers."
+            methodology = get_methodology_context(user_message)
+            if methodology:
+                system_prompt += f"\n\nGround your answer in this Nivalis methodology:\n\n{methodology}"
+        
+        with span('openai'):
+            response = client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                max_tokens=800,
+                temperature=0.7
+            )
         
         return response.choices[0].message.content
         
@@ -78,10 +114,91 @@ def get_ai_response(user_message, user_id):
         logger.error(f"OpenAI error: {e}")
         return "I'm ready to help you build high-ticket offers. What would you like to work on?"
 
+PAID_TIERS = ['basic', 'mvp_lifetime', 'premium']
+
+# Onboarding schema serialized and compressed once per process
+ONBOARDING_SCHEMA = CompressedAsset(QUESTIONS_JSON, 'application/json')
+
+# Bump whenever the dashboard builders change what they return, so cached
+# bodies from before a deploy stop revalidating as current
+DASHBOARD_PAYLOAD_VERSION = 1
+
+def load_current_user():
+    """Read the authenticated user record once per request"""
+    if 'current_user' not in g:
+        from auth import UserManager
+        g.current_user = UserManager.get_user(g.telegram_id)
+    return g.current_user
+
+def dashboard_etag(user):
+    """Build an ETag from the payload version and the user record's last update"""
+    seed = f"{DASHBOARD_PAYLOAD_VERSION}:{user.get('telegram_id', '')}:{user.get('updated_at', '')}"
+    return hashlib.sha1(seed.encode('utf-8')).hexdigest()[:16]
+
+def build_dashboard_stats(user):
+    """Summary numbers for the dashboard overview"""
+    onboarding_data = user.get('onboarding_data') or {}
+    return {
+        'active_strategies': len(user.get('strategies', [])),
+        'revenue_potential': onboarding_data.get('income_goal') or 'TBD',
+        'execution_score': 'Profile Complete' if user.get('onboarding_completed') else 'New User'
+    }
+
+def build_profile_data(user):
+    """Flatten the stored profile for the dashboard profile section"""
+    if not user.get('onboarding_completed'):
+        return None
+    
+    data = user.get('onboarding_data') or {}
+    return {
+        'name': user.get('name') or data.get('name'),
+        'email': user.get('email') or data.get('email'),
+        'current_income': data.get('current_income'),
+        'income_goal': data.get('income_goal'),
+        'experience_level': data.get('business_experience'),
+        'current_stage': data.get('current_stage'),
+        'skills': data.get('skills_expertise', [])
+    }
+
+def build_subscription_data(user):
+    """Subscription status for the dashboard subscription section"""
+    plan = user.get('subscription_status', 'none')
+    return {
+        'active': plan in PAID_TIERS,
+        'plan': plan if plan != 'none' else None,
+        'start_date': user.get('subscription_started_at'),
+        'next_billing': user.get('next_billing')
+    }
+
+def dashboard_response(builder):
+    """Serve builder(user) as JSON, answering 304 while the user is unchanged"""
+    user = load_current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'User not found'}), 404
+    
+    etag = dashboard_etag(user)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(builder(user))
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def build_dashboard_payload(user):
+    """Aggregated stats, profile and subscription"""
+    return {
+        'success': True,
+        'stats': build_dashboard_stats(user),
+        'profile': build_profile_data(user),
+        'subscription': build_subscription_data(user)
+    }
+
 @app.route('/')
 def index():
     """Landing page"""
-    return render_template('index.html')
+    return static_pipeline.render_page('index.html')
 
 @app.route('/health')
 def health():
@@ -92,22 +209,44 @@ def health():
 def telegram_webhook():
     """Handle Telegram webhook"""
     try:
-        data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({'ok': True})
-        
-        message = data['message']
-        chat_id = message['chat']['id']
-        user_id = message['from']['id']
-        text = message.get('text', '')
-        
-        logger.info(f"Message from user {user_id}: {text}")
+        with span('parse_json'):
+            data = request.get_json()
+        dispatch_update(data, forwarded=router.is_forwarded(request.headers))
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+    return jsonify({'ok': True})
+
+def dispatch_update(data, forwarded=False):
+    """Forward the update to the node owning its chat, or handle it here"""
+    if data and forwarded:
+        # Acknowledged right away so the forwarding node's worker is released
+        if forwarded_updates.submit(data):
+            return
+    elif data:
+        with span('forward'):
+            if router.forward(data):
+                return
+    handle_update(data)
+
+def handle_update(data):
+    """Process one Telegram update (shared by the webhook and polling.py)"""
+    if not data or 'message' not in data:
+        return
+    
+    message = data['message']
+    chat_id = message['chat']['id']
+    user_id = message['from']['id']
+    text = message.get('text', '')
+    
+    logger.info("Message from user %s: %s", user_id, redact_text(text),
+                extra={'event': 'telegram_message', 'user_id': user_id})
+    
+    if is_subscriber(user_id):
+        logger.info("Subscriber access granted to user %s", user_id,
+                    extra={'event': 'subscriber_access', 'user_id': user_id})
         
-        if is_subscriber(user_id):
-            logger.info(f"Subscriber access granted to user {user_id}")
-            
-            if text == '/start':
-                welcome_msg = """🎯 <b>Welcome to Nivalis - Your Access is Confirmed</b>
+        if text == '/start':
+            welcome_msg = """🎯 <b>Welcome to Nivalis - Your Access is Confirmed</b>
 
 I'm Antonio's digital clone, ready to help you transform your expertise into recurring revenue.
 
@@ -117,25 +256,21 @@ Simply tell me:
 • What you want to achieve
 
 What would you like to work on first?"""
-                
-                send_telegram_message(chat_id, welcome_msg)
-            else:
-                ai_response = get_ai_response(text, user_id)
-                send_telegram_message(chat_id, ai_response)
+            
+            send_telegram_message(chat_id, welcome_msg)
         else:
-            access_msg = """🔒 <b>Nivalis Access Required</b>
+            ai_response = get_ai_response(text, user_id)
+            send_telegram_message(chat_id, ai_response)
+    else:
+        access_msg = """🔒 <b>Nivalis Access Required</b>
 
 Get lifetime access for £97 at: https://web-production-8ff6.up.railway.app
 
 Transform your expertise into recurring monthly revenue."""
-            
-            send_telegram_message(chat_id, access_msg)
         
-        return jsonify({'ok': True})
-        
-    except Exception as e:
-        logger.error(f"Webhook error: {e}")
-        return jsonify({'ok': True})
+        send_telegram_message(chat_id, access_msg)
+
+forwarded_updates = ForwardedQueue(handle_update)
 
 @app.route('/create-mvp-checkout-session', methods=['POST'])
 def create_mvp_checkout_session():
@@ -149,17 +284,18 @@ def create_mvp_checkout_session():
         
         domain = 'web-production-8ff6.up.railway.app'
         
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price': 'price_1RbiItDhGdG2vys0psbkEGDd',
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f'https://{domain}/success',
-            cancel_url=f'https://{domain}/cancel',
-            metadata={'product': 'nivalis_founder_access'}
-        )
+        with span('stripe_checkout'):
+            checkout_session = stripe.checkout.Session.create(
+                payment_method_types=['card'],
+                line_items=[{
+                    'price': 'price_1RbiItDhGdG2vys0psbkEGDd',
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=f'https://{domain}/success',
+                cancel_url=f'https://{domain}/cancel',
+                metadata={'product': 'nivalis_founder_access'}
+            )
         
         return redirect(checkout_session.url, code=303)
         
@@ -171,12 +307,12 @@ def create_mvp_checkout_session():
 def success():
     """Payment success page"""
     session['payment_confirmed'] = True
-    return render_template('success.html')
+    return static_pipeline.render_page('success.html')
 
 @app.route('/cancel')
 def cancel():
     """Payment cancelled page"""
-    return render_template('cancel.html')
+    return static_pipeline.render_page('cancel.html')
 
 @app.route('/onboarding')
 def onboarding():
@@ -193,6 +329,14 @@ def complete_onboarding():
         if not data or 'answers' not in data:
             return jsonify({'success': False, 'error': 'Answers required'}), 400
         
+        # Persist through OnboardingFlow when the client is signed in
+        auth_header = request.headers.get('Authorization', '')
+        telegram_id = verify_token(auth_header[7:]) if auth_header.startswith('Bearer ') else None
+        if telegram_id:
+            saved, errors = OnboardingFlow.submit_answers(telegram_id, data['answers'])
+            if not saved:
+                return jsonify({'success': False, 'errors': errors}), 400
+        
         session['onboarding_complete'] = True
         session['user_profile'] = data['answers']
         
@@ -204,5 +348,56 @@ def complete_onboarding():
         logger.error(f"Onboarding error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/onboarding/questions')
+def onboarding_questions():
+    """Onboarding question schema as cacheable JSON"""
+    return ONBOARDING_SCHEMA.respond(app, 'public, max-age=3600')
+
+@app.route('/api/onboarding/submit', methods=['POST'])
+@require_auth
+def submit_onboarding():
+    """Validate and store every onboarding answer in one request"""
+    try:
+        data = request.get_json(silent=True)
+        if not data or not isinstance(data.get('answers'), dict):
+            return jsonify({'success': False, 'error': 'Answers required'}), 400
+        
+        saved, errors = OnboardingFlow.submit_answers(g.telegram_id, data['answers'])
+        if not saved:
+            return jsonify({'success': False, 'errors': errors}), 400
+        
+        session['onboarding_complete'] = True
+        session['user_profile'] = data['answers']
+        
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        logger.error(f"Batch onboarding error: {e}")
+        return jsonify({'success': False, 'error': 'Onboarding failed'}), 500
+
+@app.route('/api/dashboard')
+@require_auth
+def dashboard_api():
+    """Aggregated dashboard data in a single authenticated request"""
+    return dashboard_response(build_dashboard_payload)
+
+@app.route('/api/dashboard-data')
+@require_auth
+def dashboard_data():
+    """Dashboard stats (kept for older clients, prefer /api/dashboard)"""
+    return dashboard_response(lambda user: {'success': True, 'stats': build_dashboard_stats(user)})
+
+@app.route('/api/profile-data')
+@require_auth
+def profile_data():
+    """Profile data (kept for older clients, prefer /api/dashboard)"""
+    return dashboard_response(lambda user: {'success': True, 'profile': build_profile_data(user)})
+
+@app.route('/api/subscription-data')
+@require_auth
+def subscription_data():
+    """Subscription data (kept for older clients, prefer /api/dashboard)"""
+    return dashboard_response(lambda user: {'success': True, 'subscription': build_subscription_data(user)})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)